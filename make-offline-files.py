@@ -5,11 +5,54 @@ import sys
 import os
 import re
 import argparse
+import atexit
+import collections
+import functools
+import hashlib
+import io
 import logging
+import pickle
 import textwrap
+import time
+import shutil
 import subprocess
+import struct
 from pathlib import Path
 from enum import Enum
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+
+# These are used for the main file, so they are compiled only once
+_MARKDOWN_HEADING_MARKER_RE = re.compile(r'(#+)[ \t]+')
+# The main file spells the include directives "- <doc:Name>", the optional backticks also
+# accept pandoc's markdown rendering "-   `<doc:Name>`{=html}". Both of these are applied
+# to the whole text of the main file at once.
+_DOCUMENT_INCLUDE_LINES_RE = re.compile(r'^-[ \t]*`?<doc:(\w+)>`?.*$', re.MULTILINE)
+_LEVEL_1_HEADING_RE = re.compile(r'^# ', re.MULTILINE)
+
+# These are used for every line of every chapter. Binding their match/sub
+# methods once also saves the attribute lookup for each call.
+_match_definition_list_term = re.compile(r'- term (.+):').match
+_DOC_REFERENCE_RE = re.compile(r'<doc:([\w#-]+)>')
+_substitute_doc_references = _DOC_REFERENCE_RE.sub
+_find_doc_references = _DOC_REFERENCE_RE.findall
+_substitute_optionality_markers = re.compile(r'(\*{1,2})_\?_').sub
+_match_image_reference = re.compile(r'!\[([^\]]*)\]\(([\w-]+)\)').match
+_match_heading = re.compile(r'#+ .+').match
+
+# Rewritten chapters are cached here across runs, keyed by a hash of their inputs.
+# Entries older than the maximum age are ignored and rewritten.
+_CHAPTER_CACHE_DIRECTORY = Path('~/.cache/swiftbook-pdf').expanduser()
+_CHAPTER_CACHE_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+
+# Final ePUB/PDF files are cached here, keyed by a hash of everything pandoc reads
+_OUTPUT_CACHE_DIRECTORY = _CHAPTER_CACHE_DIRECTORY / 'out'
+_PANDOC_SUPPORT_FILE_PATHS = [
+    Path('tspl-pandoc-template.latex'),
+    Path('rewrite-retina-image-references.lua'),
+    Path('tspl-code-highlight.theme'),
+    Path('tspl-epub.css'),
+]
 
 
 def main():
@@ -20,22 +63,27 @@ def main():
     parser.add_argument('--output-path-epub', type=Path, default='The-Swift-Programming-Language.epub', help='ePUB output path')
     parser.add_argument('--debug-latex', action='store_true', help='Dump the latex intermediate code instead of the final PDF')
     parser.add_argument('--preprocess-markdown-only', action='store_true', help='Just preprocess the markdown content, don\'t produce final output')
+    parser.add_argument('--no-cache', action='store_true', help='Don\'t reuse any results cached by earlier runs')
 
     args = parser.parse_args()
 
-    generate_output(args.book_path.expanduser(), args.pandoc_path.expanduser(), args.output_path_pdf.expanduser(), args.output_path_epub.expanduser(), args.debug_latex, args.preprocess_markdown_only)
+    if args.no_cache:
+        # Forget the widths loaded from the cache file, they get probed and saved again
+        _png_width_cache.clear()
 
+    generate_output(args.book_path.expanduser(), args.pandoc_path.expanduser(), args.output_path_pdf.expanduser(), args.output_path_epub.expanduser(), args.debug_latex, args.preprocess_markdown_only, not args.no_cache)
 
-def generate_output(book_path, pandoc_path, output_path_pdf, output_path_epub, debug_latex, preprocess_markdown_only):
-    combined_markdown_path = combine_and_rewrite_markdown_files(book_path, pandoc_path)
+
+def generate_output(book_path, pandoc_path, output_path_pdf, output_path_epub, debug_latex, preprocess_markdown_only, use_cache):
+    combined_markdown_path = combine_and_rewrite_markdown_files(book_path, use_cache)
     print(f'Preprocessed Markdown content written to {combined_markdown_path}')
 
     if preprocess_markdown_only:
         return
 
+    pandoc = os.fspath(pandoc_path)
+
     common_options = [
-        '--from', 'markdown',
-        os.fspath(combined_markdown_path),
         '--resource-path', os.fspath(book_path / 'TSPL.docc/Assets'),
         '--highlight-style', 'tspl-code-highlight.theme',
         '--standalone',
@@ -70,100 +118,437 @@ def generate_output(book_path, pandoc_path, output_path_pdf, output_path_epub, d
         ]
         option_sets.append(common_options + pdf_options)
 
+    # Running pandoc, and lualatex in particular, takes much longer than everything
+    # else. If the inputs of a conversion haven't changed since an earlier run,
+    # reuse that run's output instead. Only the latest output of each set of options is
+    # kept, next to the key of the inputs it was produced from.
+    pandoc_inputs_key = pandoc_inputs_cache_key(combined_markdown_path, book_path, pandoc_path)
+    pending_option_sets = []
     for options in option_sets:
-        cmd = [os.fspath(pandoc_path)] + options
-        if subprocess.run(cmd, text=True).returncode:
-            print(f'pandoc command execution failure:\n{shlex.join(cmd)}')
+        output_path = output_path_from_pandoc_options(options)
+        options_key = hashlib.blake2b('\0'.join(options).encode(), digest_size=16).hexdigest()
+        cache_path = _OUTPUT_CACHE_DIRECTORY / f'{options_key}{Path(output_path).suffix}'
+        cache_key_path = cache_path.with_suffix('.key')
+        if use_cache and pandoc_inputs_key and cache_path.exists() and cache_key_path.exists() and cache_key_path.read_text() == pandoc_inputs_key:
+            shutil.copyfile(cache_path, output_path)
+            print(f'Output written to {output_path} (unchanged, copied from cache)')
         else:
-            output_path = next(x for i, x in enumerate(options) if i and options[i - 1] == '--output')
-            print(f'Output written to {output_path}')
+            pending_option_sets.append((options, cache_path))
 
+    if not pending_option_sets:
+        return
+
+    input_options = ['--from', 'markdown', os.fspath(combined_markdown_path)]
+
+    if len(pending_option_sets) > 1:
+        # Both output formats are produced from the same document. Parsing the markdown is
+        # one of the most expensive parts of each conversion, so parse it only once into
+        # pandoc's JSON representation of the document and let both conversions read that.
+        combined_json_path = combined_markdown_path.with_suffix('.json')
+        cmd = [pandoc] + input_options + ['--to', 'json', '--output', os.fspath(combined_json_path)]
+        result = subprocess.run(cmd)
+        if result.returncode:
+            print(f'pandoc command execution failure:\n{shlex.join(result.args)}')
+            return
+        input_options = ['--from', 'json', os.fspath(combined_json_path)]
+
+    # The ePUB and PDF conversions are independent of each other and each one
+    # mostly keeps a single core busy, so run them concurrently. The actual work
+    # happens in the pandoc child processes, threads are sufficient to wait for them.
+    with ThreadPoolExecutor(max_workers=len(pending_option_sets)) as executor:
+        futures = {}
+        for options, cache_path in pending_option_sets:
+            cmd = [pandoc] + input_options + options
+            futures[executor.submit(subprocess.run, cmd, text=True, capture_output=True)] = (options, cache_path)
+
+        for future in as_completed(futures):
+            options, cache_path = futures[future]
+            result = future.result()
+            # Output is captured so that the messages of the concurrent runs don't interleave
+            sys.stdout.write(result.stdout)
+            sys.stderr.write(result.stderr)
+            if result.returncode:
+                print(f'pandoc command execution failure:\n{shlex.join(result.args)}')
+            else:
+                output_path = output_path_from_pandoc_options(options)
+                if pandoc_inputs_key:
+                    # This replaces the output of the previous run with the same options. Its key
+                    # is removed first so that a partially copied file never counts as valid.
+                    cache_key_path = cache_path.with_suffix('.key')
+                    cache_path.parent.mkdir(parents=True, exist_ok=True)
+                    cache_key_path.unlink(missing_ok=True)
+                    shutil.copyfile(output_path, cache_path)
+                    cache_key_path.write_text(pandoc_inputs_key)
+                print(f'Output written to {output_path}')
+
+
+def output_path_from_pandoc_options(options):
+    return next(x for i, x in enumerate(options) if i and options[i - 1] == '--output')
+
+
+def pandoc_inputs_cache_key(combined_markdown_path, book_path, pandoc_path):
+    # Everything a pandoc run reads besides its options: the document, the support
+    # files referenced by the options, the images and the pandoc executable itself.
+    # The support files are looked up relative to the current directory, just like
+    # pandoc does. If one of them can't be read, there is no key and the output isn't
+    # cached, pandoc then reports the problem when it runs.
+    key = hashlib.blake2b()
+    try:
+        with combined_markdown_path.open('rb') as f:
+            while chunk := f.read(1 << 20):
+                key.update(chunk)
+        for support_file_path in _PANDOC_SUPPORT_FILE_PATHS:
+            key.update(support_file_path.read_bytes())
+        for path in [Path(shutil.which(pandoc_path) or pandoc_path)] + image_asset_paths(book_path):
+            stat = path.stat()
+            key.update(f'{path}\0{stat.st_mtime_ns}\0{stat.st_size}\n'.encode())
+    except OSError:
+        return None
+    return key.hexdigest()
+
+
+def combine_and_rewrite_markdown_files(book_path, use_cache):
+    combined_markdown_path = Path('swiftbook-combined.md')
+
+    # Regenerating the combined file means reading and rewriting every chapter. Skip that
+    # if none of the inputs (nor this script) changed since the combined file was written.
+    cache_key_path = Path('.swiftbook-combined.cache')
+    cache_key = combined_markdown_cache_key(book_path)
+    if use_cache and combined_markdown_path.exists() and cache_key_path.exists() and cache_key_path.read_text().splitlines()[:1] == [cache_key]:
+        return combined_markdown_path
 
-def combine_and_rewrite_markdown_files(book_path, pandoc_path):
     # Preprocess the main md file that pulls in all the per-chapter files and shift up its headings by
     # two levels. We want to get the few headings ("Language Guide", "Language Reference" etc.) that introduce
     # related sets of chapters up to level 1, so that they become the toplevel heading structure visible in
     # the table of contents.
-    cmd = [os.fspath(pandoc_path), '--from', 'markdown', '--to', 'markdown', os.fspath(book_path / 'TSPL.docc/The-Swift-Programming-Language.md'), '--shift-heading-level-by=-2']
-    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-    main_file_markdown_text = result.stdout
+    main_file_markdown_text = (book_path / 'TSPL.docc/The-Swift-Programming-Language.md').read_text()
+    main_file_markdown_text = shift_markdown_heading_levels_up_by_two(main_file_markdown_text)
 
     # This preprocessing step of the main file performs the inclusion of all referenced
     # per-chapter files, resulting in one large markdown file that contains all content,
-    # which we then run through pandoc.
-    combined_book_markdown_lines = preprocess_main_file_markdown(book_path, main_file_markdown_text)
-    combined_markdown_path = Path('swiftbook-combined.md')
-    combined_markdown_path.write_text('\n'.join(combined_book_markdown_lines))
+    # which we then run through pandoc. The content is streamed into the file as it
+    # gets produced instead of first collecting the whole book in memory. The key of the
+    # previous combined file is removed first, so that an interrupted run never leaves
+    # a partially written file behind that a later run would consider up to date.
+    cache_key_path.unlink(missing_ok=True)
+    with combined_markdown_path.open('w', encoding='utf-8', buffering=1 << 20) as f:
+        preprocess_main_file_markdown(book_path, main_file_markdown_text, use_cache, f)
+    cache_key_path.write_text(cache_key + '\n')
     return combined_markdown_path
 
 
-def preprocess_main_file_markdown(book_path, main_markdown_file_text):
+def combined_markdown_cache_key(book_path):
+    # File modification times and sizes are good enough to detect changes,
+    # this way we only need to stat the input files instead of reading them.
+    key = hashlib.blake2b(os.fspath(book_path.resolve()).encode())
+    # The header of the combined file shows the git tag or branch and its date,
+    # which can change without any of the files changing
+    ref, date = git_tag_or_ref_and_date_for_working_copy_path(book_path)
+    key.update(f'{ref}\0{date}\0'.encode())
+    input_paths = sorted([*book_path.rglob('*.md'), *image_asset_paths(book_path)])
+    for path in [Path(__file__)] + input_paths:
+        stat = path.stat()
+        key.update(f'{path}\0{stat.st_mtime_ns}\0{stat.st_size}\0'.encode())
+    return key.hexdigest()
+
+
+# The image assets are part of several cache keys, so the
+# assets directory tree is walked only once per run
+@functools.lru_cache(maxsize=None)
+def image_asset_paths(book_path):
+    return sorted((book_path / 'TSPL.docc/Assets').rglob('*.png'))
+
+
+def shift_markdown_heading_levels_up_by_two(text):
+    # This does the same as pandoc's --shift-heading-level-by=-2 without the cost of
+    # launching pandoc: headings that would end up at level 0 or below turn into regular
+    # paragraphs, all others lose two levels. Like a real markdown parser, it leaves
+    # lines in fenced code blocks alone even if they happen to start with "#".
+    out = []
+    in_code_block = False
+    for line in io.StringIO(text):
+        if line.startswith(('```', '~~~')):
+            in_code_block = not in_code_block
+        elif not in_code_block and (match := _MARKDOWN_HEADING_MARKER_RE.match(line)):
+            level = len(match.group(1)) - 2
+            line = ('#' * level + ' ' if level > 0 else '') + line[match.end():]
+        out.append(line)
+    return ''.join(out)
+
+
+def preprocess_main_file_markdown(book_path, main_markdown_file_text, use_cache, out):
     # The DocC inclusion directives as well as cross-references refer to the per-chapter
     # files with the "stem", the filename without extension. We need to be able to map
     # from those stems to the full file paths and also to the human-readable document
     # titles for each file, so build a mapping here that we can then pass around.
-    paths_and_titles_mapping = book_markdown_file_stems_to_paths_and_titles_mapping(book_path)
+    paths_and_titles_mapping = book_markdown_file_stems_to_paths_and_titles_mapping(book_path, use_cache)
+    # The same cross-references appear over and over throughout the book,
+    # so we derive the pandoc link for each of them only once.
+    docc_reference_links = DoccReferenceLinks(paths_and_titles_mapping)
 
     # Converting the entire book takes a while, this lets us pick a chapter subset
     # when we need to iterate more quickly on a specific conversion problem.
     debug_chapters_subset = None
     # debug_chapters_subset = set(['Closures', 'Enumerations', 'Properties'])
 
-    # combined_book_markdown_lines is where we accumulate all lines of the big combined
-    # markdown file. We start it out with a YAML header section that lets us control
-    # many details of the pandoc conversion.
-    combined_book_markdown_lines = markdown_header_lines(book_path)
-
-    # Because of the heading level shifting we performed earlier on the main file,
-    # there will be some paragraphs that were formerly headings that we no longer need.
-    # This state machine skips over that content until we reach the first heading and then
-    # starts processing the DocC <doc:... include directives.
-    class ParserState(Enum):
-        WAITING_FOR_FIRST_HEADING = 1
-        PROCESSING_DOCUMENT_INCLUDES = 2
-
-    state = ParserState.WAITING_FOR_FIRST_HEADING
-    for line in main_markdown_file_text.splitlines():
-        match state:
-            case ParserState.WAITING_FOR_FIRST_HEADING:
-                if line.startswith('# '):
-                    state = ParserState.PROCESSING_DOCUMENT_INCLUDES
-                    combined_book_markdown_lines.append(line)                
-            case ParserState.PROCESSING_DOCUMENT_INCLUDES:
-                if match := re.match(r'^-\s*`<doc:(\w+)>`.*$', line):
-                    # We found a chapter include directive, process and add
-                    # the lines of the referenced file at this point
-                    markdown_file_to_include_stem = match.group(1)
-                    if not debug_chapters_subset or markdown_file_to_include_stem in debug_chapters_subset:
-                        combined_book_markdown_lines.extend(lines_for_included_document(markdown_file_to_include_stem, paths_and_titles_mapping, book_path))
-                    continue
-
-                # The line is something else, add it to the combined output unchanged
-                if line.startswith('# '):
-                    combined_book_markdown_lines.append(r'\newpage{}')
-                combined_book_markdown_lines.append(line)
-
-    return combined_book_markdown_lines
+    # Rewriting a chapter only depends on its own text, the links its cross-references
+    # resolve to, the image widths and this script. This digest of what all chapters
+    # share is part of each chapter's cache key, the rest is added per chapter.
+    png_widths = png_widths_for_image_assets(book_path)
+    chapter_cache_context = chapter_cache_context_key(book_path, png_widths)
+    remove_expired_chapter_cache_entries()
+
+    book_title = paths_and_titles_mapping['The-Swift-Programming-Language'][1]
+
+    # We start the combined file out with a YAML header section that lets
+    # us control many details of the pandoc conversion.
+    out.writelines(line + '\n' for line in markdown_header_lines(book_path, book_title))
+
+    # All included chapter files get rewritten up front. They are independent of each other,
+    # so we spread them over multiple processes. Everything the chapters share is handed to
+    # each worker process once when it starts, not for every chapter. The results come back
+    # in the order of the include directives, so the loop below can write out each chapter
+    # as soon as it reaches its directive. Only a few chapters per worker are rewritten ahead
+    # of the loop, so the finished chapters that wait for it don't add up to the whole book.
+    stems_to_include = [stem for stem in included_document_stems(main_markdown_file_text) if not debug_chapters_subset or stem in debug_chapters_subset]
+    worker_state = (paths_and_titles_mapping, docc_reference_links, png_widths, chapter_cache_context, use_cache)
+    worker_count = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=worker_count, initializer=initialize_chapter_rewriting_worker, initargs=(worker_state,)) as executor:
+        rewritten_documents = rewritten_included_documents_in_order(executor, stems_to_include, 2 * worker_count)
+
+        # Because of the heading level shifting we performed earlier on the main file,
+        # there will be some paragraphs that were formerly headings that we no longer need.
+        # We skip over that content until we reach the first heading. The rest of the file is
+        # copied in one piece per stretch between two DocC <doc:... include directives, with
+        # each directive replaced by the rewritten chapter it refers to.
+        first_heading = _LEVEL_1_HEADING_RE.search(main_markdown_file_text)
+        if first_heading:
+            # The first heading itself doesn't need a page break in front of it
+            position = main_markdown_file_text.find('\n', first_heading.start()) + 1 or len(main_markdown_file_text)
+            write_main_file_content(main_markdown_file_text[first_heading.start():position], out)
+            for match in _DOCUMENT_INCLUDE_LINES_RE.finditer(main_markdown_file_text, position):
+                out.write(main_file_content_with_page_breaks(main_markdown_file_text[position:match.start()]))
+                position = match.end() + 1
+                # We found a chapter include directive, add the
+                # lines of the referenced file at this point
+                if not debug_chapters_subset or match.group(1) in debug_chapters_subset:
+                    stem, (lines, new_title_cache_entries) = next(rewritten_documents)
+                    assert stem == match.group(1)
+                    out.writelines(chapter_line + '\n' for chapter_line in lines)
+                    paths_and_titles_mapping.new_cache_entries.update(new_title_cache_entries)
+            write_main_file_content(main_file_content_with_page_breaks(main_markdown_file_text[position:]), out)
+
+    paths_and_titles_mapping.save_cache()
+
+
+def included_document_stems(main_markdown_file_text):
+    # This finds the include directives the same way preprocess_main_file_markdown()
+    # does, ignoring those before the first heading
+    first_heading = _LEVEL_1_HEADING_RE.search(main_markdown_file_text)
+    if not first_heading:
+        return []
+    return _DOCUMENT_INCLUDE_LINES_RE.findall(main_markdown_file_text, first_heading.start())
+
+
+def main_file_content_with_page_breaks(text):
+    # Each of the toplevel sections of the book starts on a new page
+    return _LEVEL_1_HEADING_RE.sub(r'\\newpage{}\n# ', text)
+
+
+def write_main_file_content(text, out):
+    out.write(text)
+    if text and not text.endswith('\n'):
+        out.write('\n')
+
+
+def rewritten_included_documents_in_order(executor, markdown_file_stems, max_documents_in_flight):
+    # Unlike executor.map(), which submits everything at once, this keeps at most
+    # the given number of chapters submitted or finished but not yet consumed
+    futures = collections.deque()
+    for markdown_file_stem in markdown_file_stems:
+        futures.append((markdown_file_stem, executor.submit(lines_and_new_cache_entries_for_included_document, markdown_file_stem)))
+        if len(futures) >= max_documents_in_flight:
+            stem, future = futures.popleft()
+            yield stem, future.result()
+    while futures:
+        stem, future = futures.popleft()
+        yield stem, future.result()
+
+
+# The state shared by all chapters that a chapter rewriting worker process works on
+_chapter_rewriting_worker_state = None
+
+
+def initialize_chapter_rewriting_worker(worker_state):
+    global _chapter_rewriting_worker_state
+    _chapter_rewriting_worker_state = worker_state
+
+
+def lines_and_new_cache_entries_for_included_document(markdown_file_stem):
+    # Worker processes don't write the titles cache file, so we report any
+    # newly read titles back to the parent process which does.
+    paths_and_titles_mapping = _chapter_rewriting_worker_state[0]
+    lines = lines_for_included_document(markdown_file_stem, *_chapter_rewriting_worker_state)
+    new_title_cache_entries = dict(paths_and_titles_mapping.new_cache_entries)
+    paths_and_titles_mapping.new_cache_entries.clear()
+    return lines, new_title_cache_entries
+
+
+def book_markdown_file_stems_to_paths_and_titles_mapping(book_path, use_cache):
+    cached_titles = {}
+    if use_cache:
+        try:
+            with PathsAndTitlesMapping.cache_path.open('rb') as f:
+                cached_titles = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+
+    return PathsAndTitlesMapping({path.stem: path for path in book_path.rglob('*.md')}, cached_titles)
+
+
+class PathsAndTitlesMapping(dict):
+    # This maps stems to (path, title) tuples. A file's title is only looked up the first
+    # time its stem is used, so files that nothing includes or refers to are never read.
+    # The titles are cached across runs in a file that maps each stem to the file path,
+    # title and modification time, so that unchanged files only need to be stat'ed.
+    cache_path = Path('.stems.cache')
+
+    def __init__(self, paths, cached_titles):
+        super().__init__()
+        self.paths = paths
+        self.cached_titles = cached_titles
+        self.new_cache_entries = {}
+
+    def __missing__(self, stem):
+        path = self.paths[stem]
+        path_string = os.fspath(path)
+        mtime_ns = path.stat().st_mtime_ns
+        cached = self.cached_titles.get(stem)
+        if cached and cached[0] == path_string and cached[2] == mtime_ns:
+            title = cached[1]
+        else:
+            title = title_from_first_heading_in_markdown_file(path)
+            self.new_cache_entries[stem] = (path_string, title, mtime_ns)
+        self[stem] = (path, title)
+        return path, title
+
+    def save_cache(self):
+        cache = {stem: entry for stem, entry in (self.cached_titles | self.new_cache_entries).items() if stem in self.paths}
+        if cache != self.cached_titles:
+            with self.cache_path.open('wb') as f:
+                pickle.dump(cache, f)
+
+
+class DoccReferenceLinks(dict):
+    # This maps DocC references, "Document" or "Document#Section",
+    # to pandoc markdown links, creating each link when it is first needed
+    def __init__(self, paths_and_titles_mapping):
+        super().__init__()
+        self.paths_and_titles_mapping = paths_and_titles_mapping
+
+    def __missing__(self, reference):
+        if '#' in reference:
+            _, section = reference.split('#')
+            human_readable_label = section.replace('-', ' ')
+        else:
+            human_readable_label = self.paths_and_titles_mapping[reference][1]
+        link = self[reference] = pandoc_markdown_link_for_label(human_readable_label)
+        return link
+
+
+def pandoc_markdown_link_for_label(human_readable_label):
+    identifier = human_readable_label.lower().replace(' ', '-')
+    return f'[{human_readable_label}](#{identifier})'
+
+
+def chapter_cache_context_key(book_path, png_widths):
+    key = hashlib.blake2b(os.fspath(book_path.resolve()).encode())
+    key.update(Path(__file__).read_bytes())
+    for image_filename_prefix, width in sorted(png_widths.items()):
+        key.update(f'{image_filename_prefix}\0{width}\0'.encode())
+    return key.digest()
+
+
+def remove_expired_chapter_cache_entries():
+    # Every change to a chapter creates a new entry and the entry it replaces
+    # is never looked up again. Entries don't get refreshed when they are used,
+    # so anything past the maximum age can go, replaced or not. The same goes for
+    # temporary files left behind by interrupted runs.
+    expiry_time = time.time() - _CHAPTER_CACHE_MAX_AGE_SECONDS
+    try:
+        with os.scandir(_CHAPTER_CACHE_DIRECTORY) as entries:
+            expired_paths = [Path(entry.path) for entry in entries if entry.name.endswith(('.txt', '.tmp')) and entry.is_file() and entry.stat().st_mtime < expiry_time]
+    except FileNotFoundError:
+        return
+    for path in expired_paths:
+        path.unlink(missing_ok=True)
 
 
-def book_markdown_file_stems_to_paths_and_titles_mapping(book_path):
-    return dict([(path.stem, (path, title_from_first_heading_in_markdown_file(path))) for path in book_path.rglob('*.md')])
+def cached_chapter_lines(cache_path):
+    try:
+        if time.time() - cache_path.stat().st_mtime > _CHAPTER_CACHE_MAX_AGE_SECONDS:
+            return None
+        return cache_path.read_text(encoding='utf-8').split('\n')
+    except OSError:
+        return None
 
 
-def lines_for_included_document(markdown_file_stem, paths_and_titles_mapping, book_path):
-    markdown_file_path = paths_and_titles_mapping[markdown_file_stem][0]
+def lines_for_included_document(markdown_file_stem, paths_and_titles_mapping, docc_reference_links, png_widths, chapter_cache_context, use_cache):
+    # Looking up just the path doesn't require reading the file's title
+    markdown_file_path = paths_and_titles_mapping.paths[markdown_file_stem]
     text = markdown_file_path.read_text()
-    # TODO: remove this regex processing after non-well-formed HTML comments
+
+    # TODO: remove this comment stripping after non-well-formed HTML comments
     # (containing double dashes) are fixed in the upstream book sources
-    text = re.sub(r'<!--.+?-->', '', text, flags=re.DOTALL)
-    lines = rewrite_docc_markdown_chapter_file_for_pandoc(text.splitlines(), paths_and_titles_mapping, book_path)
+    text = text_without_html_comments(text)
+
+    # Only the titles of the documents this chapter refers to go into its key,
+    # so that editing one chapter doesn't invalidate the entries of all others
+    key = hashlib.blake2b(text.encode() + chapter_cache_context, digest_size=16)
+    for reference in sorted(set(_find_doc_references(text))):
+        key.update(f'{reference}\0{docc_reference_links[reference]}\0'.encode())
+    cache_path = _CHAPTER_CACHE_DIRECTORY / f'{key.hexdigest()}.txt'
+    if use_cache and (lines := cached_chapter_lines(cache_path)) is not None:
+        return lines
+
+    # Iterating over the text avoids materializing a list of all chapter lines up front
+    markdown_lines = (line.rstrip('\n') for line in io.StringIO(text))
+    lines = rewrite_docc_markdown_chapter_file_for_pandoc(markdown_lines, docc_reference_links, png_widths)
     # This enforces a page break after a chapter for PDF output and 
     # it doesn't seem to negatively impact the ePUB output.
-    return [r'\newpage{}'] + lines + ['']
+    lines = [r'\newpage{}'] + lines + ['']
 
+    # The entry is written to a temporary file first and then moved into place, so that an
+    # interrupted run or another worker reading the same entry never sees a partial file
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_cache_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    temporary_cache_path.write_text('\n'.join(lines), encoding='utf-8')
+    os.replace(temporary_cache_path, cache_path)
+    return lines
 
-def rewrite_docc_markdown_chapter_file_for_pandoc(markdown_lines, paths_and_titles_mapping, book_path):
+
+def text_without_html_comments(text):
+    # A plain substring search finds the comment delimiters in linear
+    # time, a regular expression doesn't help with fixed strings like these
+    out = []
+    position = 0
+    while (comment_start := text.find('<!--', position)) >= 0:
+        out.append(text[position:comment_start])
+        if (comment_end := text.find('-->', comment_start + 4)) < 0:
+            # Keep an unterminated comment opener and everything after it
+            position = comment_start
+            break
+        position = comment_end + 3
+    out.append(text[position:])
+    return ''.join(out)
+
+
+def rewrite_docc_markdown_chapter_file_for_pandoc(markdown_lines, docc_reference_links, png_widths):
     out = []
+    # The replacement callback only depends on the links mapping, so we
+    # create it once per chapter instead of once for every line
+    docc_reference_replacement = docc_reference_replacement_for_links(docc_reference_links)
+    rewritten_lines = (rewrite_docc_markdown_line_for_pandoc(line, docc_reference_replacement, png_widths) for line in markdown_lines)
 
     class ParserState(Enum):
         START = 1
@@ -171,107 +556,144 @@ def rewrite_docc_markdown_chapter_file_for_pandoc(markdown_lines, paths_and_titl
         READING_DEFINITION_LIST_DEFINITION_FIRST_LINE = 3
         READING_DEFINITION_LIST_DEFINITION = 4
 
+    # States that hand the current line on to the next state "continue" without
+    # advancing to the next line, all others consume it
     state = ParserState.START
-    pushback = None
-    while markdown_lines or pushback:
-        if pushback:
-            line = pushback
-            pushback = None
-        else:
-            line = rewrite_docc_markdown_line_for_pandoc(markdown_lines.pop(0), paths_and_titles_mapping, book_path)
-
+    line = next(rewritten_lines, None)
+    while line is not None:
         match state:
             case ParserState.START:
-                if match := re.match(r'- term (.+):', line):
+                if match := _match_definition_list_term(line):
                     out.append(match.group(1))
                     state = ParserState.START_DEFINITION_LIST
                 else:
                     out.append(line)
             case ParserState.START_DEFINITION_LIST:
-                pushback = line
                 out.append('')
                 state = ParserState.READING_DEFINITION_LIST_DEFINITION_FIRST_LINE
+                if line:
+                    continue
             case ParserState.READING_DEFINITION_LIST_DEFINITION_FIRST_LINE:
                 out.append(f':    {line.lstrip()}')
                 state = ParserState.READING_DEFINITION_LIST_DEFINITION
             case ParserState.READING_DEFINITION_LIST_DEFINITION:
                 if not line:
                     out.append('')
-                elif re.match(r'\s+', line) or not line:
+                elif line[0].isspace():
                     out.append(f'    {line.lstrip()}')
                 else:
                     state = ParserState.START
-                    pushback = line
+                    continue
+
+        line = next(rewritten_lines, None)
 
     return out
 
 
+def docc_reference_replacement_for_links(docc_reference_links):
+    def pandoc_markdown_reference_for_docc_reference_match(match):
+        return docc_reference_links[match.group(1)]
+
+    return pandoc_markdown_reference_for_docc_reference_match
+
+
 # This function performs all rewriting that can be done within a single line.
 # More complex multi-line rewriting should happen in the state machine that this is called from.
-def rewrite_docc_markdown_line_for_pandoc(line, paths_and_titles_mapping, book_path):
-    line = rewrite_docc_markdown_line_for_pandoc_internal_references(line, paths_and_titles_mapping)
-    line = rewrite_docc_markdown_line_for_pandoc_optionality_marker(line)
-    line = rewrite_docc_markdown_line_for_pandoc_image_reference(line, book_path)
-    line = rewrite_docc_markdown_line_for_pandoc_heading_level_shift(line)
-    return line
-
+# It runs for every line of the book, so the individual rewriting steps are inlined here
+# and each one is guarded by a cheap substring test, most lines need no rewriting at all.
+def rewrite_docc_markdown_line_for_pandoc(line, docc_reference_replacement, png_widths):
+    # Internal references
+    if '<doc:' in line:
+        line = _substitute_doc_references(docc_reference_replacement, line)
 
-def rewrite_docc_markdown_line_for_pandoc_heading_level_shift(line):
-    if match := re.match(r'(#+ .+)', line):
+    # This fixes the markup used for ? optionality
+    # markers used in grammar blocks
+    if '_?_' in line:
+        line = _substitute_optionality_markers(r'?\1', line)
+
+    # Image references
+    if line.startswith('![') and (match := _match_image_reference(line)):
+        caption, image_filename_prefix = match.groups()
+        image_filename = image_filename_prefix + '@2x.png'
+        width = png_widths[image_filename_prefix]
+        # Dividing the width by two and then dividing that by about 760
+        # gives us the scale factor that will match the image presentation
+        # in the online web version.
+        scale_percentage = int(float(width) / 2 / 7.6)
+        line = f'![{caption}]({image_filename}){{ width={scale_percentage}% }}'
+
+    # Heading level shift
+    if line.startswith('#') and _match_heading(line):
         # We need to shift down the heading levels for each included
         # per-chapter markdown file by one level so they line up with
         # the headings in the main file.
-        return '#' + match.group(1)
+        line = '#' + line
+
     return line
 
 
-def rewrite_docc_markdown_line_for_pandoc_image_reference(line, book_path):    
-    if not (match := re.match(r'!\[([^\]]*)\]\(([\w-]+)\)', line)):
-        return line
+# The image assets rarely change between builds, so the image widths are kept
+# across runs in a cache file. Each entry maps the image path to its
+# modification time and width.
+_png_width_cache_path = Path('.image-widths.cache')
 
-    caption, image_filename_prefix = match.groups()
-    image_filename = Path(image_filename_prefix + '@2x.png')
-    image_path = book_path / 'TSPL.docc/Assets' / image_filename
-    assert image_path.exists()
-    output = subprocess.check_output(['file', os.fspath(image_path)], text=True)
-    match = re.search(r'PNG image data, (\d+) x \d+', output)
-    assert match
-    width = match.group(1)
-    # Dividing the width by two and then dividing that by about 760
-    # gives us the scale factor that will match the image presentation
-    # in the online web version.
-    scale_percentage = int(float(width) / 2 / 7.6)
-    return f'![{caption}]({image_filename}){{ width={scale_percentage}% }}'
 
+def load_png_width_cache():
+    try:
+        with _png_width_cache_path.open('rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return {}
 
-def rewrite_docc_markdown_line_for_pandoc_internal_references(line, paths_and_titles_mapping):
-    def pandoc_markdown_reference_for_docc_reference_match(match):
-        text = match.group(1)
-        if '#' in text:
-            _, section = text.split('#')
-            human_readable_label = section.replace('-', ' ')
-        else:
-            human_readable_label = paths_and_titles_mapping[text][1]
-        identifier = human_readable_label.lower().replace(' ', '-')
-        return f'[{human_readable_label}](#{identifier})'
 
-    line = re.sub(r'<doc:([\w#-]+)>', pandoc_markdown_reference_for_docc_reference_match, line)
+def save_png_width_cache():
+    with _png_width_cache_path.open('wb') as f:
+        pickle.dump(_png_width_cache, f)
 
-    return line
 
+_png_width_cache: dict[str, tuple[int, int]] = load_png_width_cache()
+
+
+def png_width(image_path):
+    key = os.fspath(image_path)
+    mtime_ns = image_path.stat().st_mtime_ns
+    if (cached := _png_width_cache.get(key)) and cached[0] == mtime_ns:
+        return cached[1]
+
+    # The width is the first big-endian 32 bit field of the IHDR chunk, which
+    # the PNG format requires to immediately follow the 8 byte file signature.
+    with open(image_path, 'rb') as f:
+        header = f.read(24)
+    # This is the same check that file(1) performs to recognize PNG data
+    assert header[:8] == b'\x89PNG\r\n\x1a\n' and header[12:16] == b'IHDR', f'{image_path} is not a PNG file'
+    width, = struct.unpack('>I', header[16:20])
+
+    remember_png_widths({key: (mtime_ns, width)})
+    return width
 
-def rewrite_docc_markdown_line_for_pandoc_optionality_marker(line):
-    # This fixes the markup used for ? optionality
-    # markers used in grammar blocks
-    return re.sub(r'(\*{1,2})_\?_', r'?\1', line)
 
+def png_widths_for_image_assets(book_path):
+    # Image references outnumber the image files, so rather than looking up each
+    # referenced image, we get the widths of all of them in one pass over the assets.
+    # This maps the filename prefix used in the image references to the width.
+    png_widths = {}
+    with os.scandir(book_path / 'TSPL.docc/Assets') as entries:
+        for entry in entries:
+            if entry.name.endswith('@2x.png'):
+                png_widths[entry.name.removesuffix('@2x.png')] = png_width(Path(entry.path))
+    return png_widths
 
-def markdown_header_lines(book_path):
-    first_level_1_heading = title_from_first_heading_in_markdown_file(book_path / 'TSPL.docc/The-Swift-Programming-Language.md')
-    git_tag_or_ref = git_tag_or_ref_for_working_copy_path(book_path)
-    timestamp = subprocess.check_output(['git', '-C', os.fspath(book_path), 'for-each-ref', '--format', '%(taggerdate:short)', f'refs/tags/{git_tag_or_ref}'], text=True).strip()
-    if not timestamp:
-        timestamp = subprocess.check_output(['git', '-C', os.fspath(book_path), 'show', '--no-patch', '--pretty=format:%cs', git_tag_or_ref], text=True).strip()
+
+def remember_png_widths(entries):
+    _png_width_cache.update(entries)
+    # The cache file only needs to be written back if this run learned something new.
+    # Unregistering first makes sure the handler is registered only once.
+    atexit.unregister(save_png_width_cache)
+    atexit.register(save_png_width_cache)
+
+
+def markdown_header_lines(book_path, first_level_1_heading):
+    _, timestamp = git_tag_or_ref_and_date_for_working_copy_path(book_path)
     assert len(timestamp)
 
     return textwrap.dedent(f'''\
@@ -307,19 +729,31 @@ def markdown_header_lines(book_path):
 
 
 def title_from_first_heading_in_markdown_file(path):
-    with path.open() as f:
-        return next((line[2:].strip() for line in f if line.startswith('# ')), None)
-
-
-def git_tag_or_ref_for_working_copy_path(working_copy_path):
-    output = subprocess.check_output(['git', '-C', os.fspath(working_copy_path), 'tag', '--points-at', 'HEAD'], text=True)
-    tags = [l for l in output.splitlines() if l]
-    if tags:
-        return tags[0]
-
-    output = subprocess.check_output(['git', '-C', os.fspath(working_copy_path), 'symbolic-ref', '--short', 'HEAD'], text=True)
-    refs = [l for l in output.splitlines() if l]
-    return refs[0]
+    # The title heading is normally the first line. Reading in binary mode stops
+    # at that line without decoding and splitting the rest of the file as text.
+    with path.open('rb') as f:
+        return next((line[2:].strip().decode('utf-8') for line in f if line.startswith(b'# ')), None)
+
+
+# This is needed for the combined file's cache key as well as its header
+@functools.lru_cache(maxsize=None)
+def git_tag_or_ref_and_date_for_working_copy_path(working_copy_path):
+    working_copy = os.fspath(working_copy_path)
+
+    # This lists the tags pointing at HEAD together with their dates in a single
+    # git invocation. Annotated tags have a tagger date, lightweight ones only
+    # the committer date of the commit they point to.
+    output = subprocess.check_output(['git', '-C', working_copy, 'for-each-ref', '--points-at=HEAD', '--format=%(refname:short)%09%(taggerdate:short)%09%(committerdate:short)', 'refs/tags/'], text=True)
+    for line in output.splitlines():
+        tag, tagger_date, committer_date = line.split('\t')
+        return tag, tagger_date or committer_date
+
+    # Without a tag, a single git invocation gives us the ref names pointing
+    # at HEAD, e.g. "HEAD -> main, origin/main", and the commit date.
+    output = subprocess.check_output(['git', '-C', working_copy, 'log', '-1', '--format=%D%n%cs', 'HEAD'], text=True)
+    ref_names, date = output.splitlines()[:2]
+    branch = next(r.strip().removeprefix('HEAD -> ') for r in ref_names.split(',') if r.strip().startswith('HEAD -> '))
+    return branch, date
 
 
 if __name__ == "__main__":